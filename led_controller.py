@@ -1,13 +1,16 @@
 import os
 import time
-import json
+import hmac
+import orjson
 import logging
 from flask import Flask, request, jsonify
 from rpi_ws281x import *
 from dotenv import load_dotenv
 import threading
+from bisect import bisect_right
+from collections import deque
 from datetime import datetime
-import traceback
+from functools import lru_cache
 import signal
 
 # Load environment variables
@@ -22,10 +25,22 @@ logging.basicConfig(
 
 # Load configuration from environment variables
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', 'CTF_SF25_LEDs_Secret')
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()  # Encoded once for constant-time comparison
 SATELLITE_COUNT = int(os.getenv('SATELLITE_COUNT', 10))  # Number of satellites
 LEDS_PER_SATELLITE = int(os.getenv('LEDS_PER_SATELLITE', 2))  # Number of LEDs per satellite
 TOTAL_LED_COUNT = SATELLITE_COUNT * LEDS_PER_SATELLITE  # Total number of LEDs
 STATE_FILE = os.getenv('STATE_FILE', 'satellite_state.json')
+JOURNAL_FILE = os.getenv('JOURNAL_FILE', 'satellite_state.log')  # Append-only state change journal
+COMPACT_INTERVAL = float(os.getenv('COMPACT_INTERVAL', 60))  # Seconds between journal compactions
+PRETTY_STATE_FILE = os.getenv('PRETTY_STATE_FILE', '').lower() in ('1', 'true', 'yes')  # Indent the state file for humans
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', 4))  # Waitress worker threads
+LED_RT_PRIORITY = int(os.getenv('LED_RT_PRIORITY', 20))  # SCHED_FIFO priority for the LED thread (0 to disable)
+LED_CPU = os.getenv('LED_CPU', '3')  # CPU core to pin the LED thread to (empty to disable)
+LED_MAX_WAIT = float(os.getenv('LED_MAX_WAIT', 1.0))  # Longest idle LED sleep; bounds drift after wall-clock jumps
+LED_MIN_MAX_WAIT = 0.05  # Floor so a bad LED_MAX_WAIT can't spin the real-time LED thread
+if not LED_MAX_WAIT >= LED_MIN_MAX_WAIT:  # Also catches NaN
+    logging.warning(f"LED_MAX_WAIT={LED_MAX_WAIT} is below {LED_MIN_MAX_WAIT}s; using {LED_MIN_MAX_WAIT}s")
+    LED_MAX_WAIT = LED_MIN_MAX_WAIT
 
 # LED Colours (GRB format)
 COLOURS = {
@@ -41,6 +56,20 @@ BRIGHTNESS = {
     'transmitting': 100 # Blue brightness
 }
 
+# Precomputed packed LED colours
+COLOR_UNSOLVED = Color(BRIGHTNESS['unsolved'], 0, 0)        # Red (GRB)
+COLOR_SOLVED = Color(0, BRIGHTNESS['solved'], 0)            # Green (GRB)
+COLOR_TRANSMITTING = Color(0, 0, BRIGHTNESS['transmitting'])  # Blue (GRB)
+COLOR_OFF = Color(0, 0, 0)
+
+# Satellite colour lookup, indexed by (solved << 1) | showing_blue
+SATELLITE_PALETTE = (
+    COLOR_UNSOLVED,      # 0b00: unsolved
+    COLOR_TRANSMITTING,  # 0b01: unsolved, transmitting blue phase
+    COLOR_SOLVED,        # 0b10: solved
+    COLOR_TRANSMITTING,  # 0b11: solved, transmitting blue phase
+)
+
 # LED strip configuration
 LED_PIN = 18  # GPIO18 (PWM0)
 LED_FREQ_HZ = 800000  # LED signal frequency in Hz
@@ -65,13 +94,25 @@ def shutdown_server():
         shutting_down = True
         print("\nReceived shutdown signal. Cleaning up...")
         running = False
+        led_wake.set()
+        if led_thread and led_thread is not threading.current_thread():
+            led_thread.join(timeout=0.5)  # Let the LED thread finish its frame so it can't repaint
         if strip:
-            set_all_pixels(Color(0, 0, 0))  # Turn off all LEDs immediately
-            strip.show()
+            set_all_pixels(COLOR_OFF)  # Turn off all LEDs
+            time.sleep(0.005)  # Give the DMA transfer and WS2812 reset latch time to complete
+            cleanup = getattr(strip, '_cleanup', None)
+            if cleanup:
+                cleanup()  # Release the DMA channel and PWM hardware
+        try:
+            flush_journal()  # Don't lose state changes still queued
+        except Exception as e:
+            logging.error(f"Error flushing journal on shutdown: {e}")
         if server:
-            server.shutdown()  # Stop the server
-            server.server_close()  # Close the server socket
-        os._exit(0)  # Force exit the program
+            server.close()  # Stop the server and close its socket
+        logging.shutdown()
+        # Everything is flushed and released; exit hard because this usually runs
+        # on the signal handler's helper thread, where sys.exit() would only end that thread
+        os._exit(0)
 
 def signal_handler(signum, frame):
     """Handle shutdown signals gracefully."""
@@ -85,24 +126,17 @@ signal.signal(signal.SIGTERM, signal_handler)
 # Initialise Flask app
 app = Flask(__name__)
 
-# Add request logging middleware
-@app.before_request
-def log_request_info():
-    print("\n=== Incoming Request ===")
-    print(f"Method: {request.method}")
-    print(f"Path: {request.path}")
-    print(f"Headers: {dict(request.headers)}")
-    print(f"Data: {request.get_data()}")
-    print(f"WEBHOOK_SECRET from env: {WEBHOOK_SECRET}")
-    print("=== End Request ===\n")
+# Serve compact, unsorted JSON (skips the indent + sort pass on every response)
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+app.config['JSON_SORT_KEYS'] = False
+if hasattr(app, 'json'):  # Flask 2.2+ JSON provider
+    app.json.compact = True
+    app.json.sort_keys = False
 
 # Add error handler
 @app.errorhandler(Exception)
 def handle_error(error):
-    print(f"\n=== Error Handler ===")
-    print(f"Error: {str(error)}")
-    print(f"Traceback: {traceback.format_exc()}")
-    print("=== Error Handler End ===\n")
+    logging.exception("Unhandled error: %s", error)
     return jsonify({'error': str(error)}), 500
 
 # Initialise NeoPixel strip
@@ -118,255 +152,620 @@ def get_satellite_led_indices(satellite_index):
 logging.info(f"Initialized LED strip with {TOTAL_LED_COUNT} LEDs ({SATELLITE_COUNT} satellites × {LEDS_PER_SATELLITE} LEDs per satellite)")
 for i in range(SATELLITE_COUNT):
     led_indices = get_satellite_led_indices(i)
-    logging.info(f"Satellite {i} controls LEDs: {list(led_indices)}")
+    logging.debug("Satellite %d controls LEDs %d-%d", i, led_indices[0], led_indices[-1])
 
-# Initialize start time for LED timing
-start_time = datetime.now()
+# Transmission window format and per-satellite schedule limit
+TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+MAX_TRANSMISSION_WINDOWS = 256
 
-def is_transmitting(transmission_times):
-    """Check if a satellite is currently transmitting"""
-    current_time = datetime.now()
-    
-    # If no transmission times, not transmitting
-    if not transmission_times:
-        return False
+# Set to wake the LED thread early (state change or shutdown)
+led_wake = threading.Event()
+
+# Initialize start time for LED timing (monotonic, immune to wall-clock jumps)
+start_mono = time.monotonic()
+
+@lru_cache(maxsize=1024)
+def parse_transmission_time(time_str):
+    """Parse a "YYYY/MM/DD HH:MM:SS" string, using the C fromisoformat fast path when possible.
     
-    # Check each transmission window
-    for start_time_str, end_time_str in transmission_times:
+    Cached by raw string, so a timestamp shared by several windows or endpoints is parsed once.
+    """
+    if (len(time_str) == 19 and time_str[4] == time_str[7] == '/' and time_str[10] == ' '
+            and time_str[13] == time_str[16] == ':'):
+        digits = time_str[0:4] + time_str[5:7] + time_str[8:10] + time_str[11:13] + time_str[14:16] + time_str[17:19]
+        if digits.isascii() and digits.isdigit():
+            return datetime.fromisoformat(time_str.replace('/', '-', 2))
+    # Anything else goes through strptime so malformed input raises the usual ValueError
+    return datetime.strptime(time_str, TIME_FORMAT)
+
+def parse_transmission_window(start_time_str, end_time_str):
+    """Parse a transmission window into (start, end) datetimes."""
+    return (parse_transmission_time(start_time_str),
+            parse_transmission_time(end_time_str))
+
+def build_transmission_schedule(transmission_times):
+    """Parse, sort and merge transmission windows into parallel (starts, ends) lists."""
+    windows = []
+    for window in transmission_times:
         try:
-            # Parse the times
-            start_time = datetime.strptime(start_time_str, "%Y/%m/%d %H:%M:%S")
-            end_time = datetime.strptime(end_time_str, "%Y/%m/%d %H:%M:%S")
-            
-            # If current time is within this window, satellite is transmitting
-            if start_time <= current_time <= end_time:
-                logging.debug(f"Satellite is transmitting: {start_time_str} to {end_time_str}")
-                return True
-        except ValueError as e:
+            windows.append(parse_transmission_window(*window))
+        except (TypeError, ValueError) as e:
             logging.error(f"Error parsing transmission time: {e}")
-            continue
+    windows.sort()
     
-    # If we get here, we're not in any transmission window
-    logging.debug("Satellite is not transmitting")
-    return False
+    # Merge overlapping windows so a binary search only needs to check one candidate
+    starts, ends = [], []
+    for window_start, window_end in windows:
+        if ends and window_start <= ends[-1]:
+            ends[-1] = max(ends[-1], window_end)
+        else:
+            starts.append(window_start)
+            ends.append(window_end)
+    return starts, ends
+
+def normalize_transmission_times(transmission_times, current_time=None):
+    """Merge overlapping windows, drop finished ones and cap the schedule length."""
+    if current_time is None:
+        current_time = datetime.now()
+    starts, ends = build_transmission_schedule(transmission_times)
+    windows = [(window_start, window_end) for window_start, window_end in zip(starts, ends)
+               if window_end >= current_time]
+    if len(windows) > MAX_TRANSMISSION_WINDOWS:
+        logging.error(f"Dropping {len(windows) - MAX_TRANSMISSION_WINDOWS} transmission windows over the limit")
+        windows = windows[:MAX_TRANSMISSION_WINDOWS]
+    return [[window_start.strftime(TIME_FORMAT), window_end.strftime(TIME_FORMAT)]
+            for window_start, window_end in windows]
+
+# Schedules keyed by id() of the transmission_times list they were built from.
+# Satellite entries are replaced rather than mutated, so a list's identity
+# uniquely identifies its contents while we hold a reference to it.
+transmission_schedules = {}
+
+def get_transmission_schedule(transmission_times):
+    """Return the cached (starts, ends) schedule for a transmission_times list."""
+    cached = transmission_schedules.get(id(transmission_times))
+    if cached is not None and cached[0] is transmission_times:
+        return cached[1]
+    if len(transmission_schedules) > 4 * SATELLITE_COUNT:
+        transmission_schedules.clear()  # Drop schedules for replaced lists
+    schedule = build_transmission_schedule(transmission_times)
+    transmission_schedules[id(transmission_times)] = (transmission_times, schedule)
+    return schedule
+
+def transmission_status(transmission_times, current_time):
+    """Return (transmitting, next_change) for a satellite from a single binary search.
+    
+    next_change is when the satellite next starts or stops transmitting, or None.
+    """
+    # If no transmission times, not transmitting
+    if not transmission_times:
+        return False, None
+    
+    # Binary search for the first window starting after now
+    starts, ends = get_transmission_schedule(transmission_times)
+    i = bisect_right(starts, current_time)
+    if i > 0 and current_time <= ends[i - 1]:
+        return True, ends[i - 1]
+    return False, (starts[i] if i < len(starts) else None)
+
+def is_transmitting(transmission_times, current_time):
+    """Check if a satellite is transmitting at current_time (read once per scan by the caller)"""
+    return transmission_status(transmission_times, current_time)[0]
 
 def load_state():
-    """Load satellite state from file."""
+    """Load satellite state from the baseline file and replay the journal on top.
+    
+    A missing or empty state file is created with the default state. An
+    unreadable one is moved aside to STATE_FILE.corrupt first, so the next
+    save can't overwrite the only copy of earlier solves.
+    """
+    global last_saved_state
+    state = None
     try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                state = json.load(f)
-                logging.info(f"Loaded state from file: {state}")
-                return state
+        if os.path.exists(STATE_FILE) and os.path.getsize(STATE_FILE) > 0:
+            with open(STATE_FILE, 'rb') as f:
+                state = orjson.loads(f.read())
+            if not isinstance(state, dict) or not isinstance(state.get('satellite_states'), list):
+                raise ValueError("missing satellite_states list")
+            for satellite in state['satellite_states']:
+                if not isinstance(satellite, dict):
+                    raise ValueError(f"invalid satellite entry {satellite!r}")
+                # Fill keys older or hand-edited files may lack; reject wrong types outright
+                satellite.setdefault('solved', False)
+                satellite.setdefault('transmission_times', [])
+                if not isinstance(satellite['solved'], bool) or not isinstance(satellite['transmission_times'], list):
+                    raise ValueError(f"invalid satellite entry {satellite!r}")
+            logging.debug("Loaded state from file: %s", state)
     except Exception as e:
+        state = None
         logging.error(f"Error loading state: {e}")
+        try:
+            os.replace(STATE_FILE, f"{STATE_FILE}.corrupt")
+            logging.error(f"Moved unreadable state file to {STATE_FILE}.corrupt")
+        except OSError as e:
+            logging.error(f"Error moving unreadable state file aside: {e}")
     
-    # Default state with transmission schedules for each satellite
-    default_state = {
-        'satellite_states': [
-            {
-                'solved': False,
-                'transmission_times': []
-            } for _ in range(SATELLITE_COUNT)
-        ]
-    }
-    return default_state
+    if state is None:
+        # Default state with transmission schedules for each satellite
+        state = {
+            'satellite_states': [
+                {
+                    'solved': False,
+                    'transmission_times': []
+                } for _ in range(SATELLITE_COUNT)
+            ]
+        }
+        if not os.path.exists(STATE_FILE) or os.path.getsize(STATE_FILE) == 0:
+            try:
+                last_saved_state = dump_state(state)
+                write_file_atomically(STATE_FILE, last_saved_state)
+                logging.info(f"Initialized state file with {SATELLITE_COUNT} satellites")
+            except Exception as e:
+                last_saved_state = None
+                logging.error(f"Error initializing state file: {e}")
+    else:
+        # Fit a state file from another SATELLITE_COUNT so every valid id has an entry
+        satellites = state['satellite_states']
+        if len(satellites) != SATELLITE_COUNT:
+            logging.warning(f"State file has {len(satellites)} satellites, expected {SATELLITE_COUNT}; resizing")
+            del satellites[SATELLITE_COUNT:]
+            satellites.extend({'solved': False, 'transmission_times': []}
+                              for _ in range(SATELLITE_COUNT - len(satellites)))
+    
+    replay_journal(state)
+    return state
+
+def write_file_atomically(path, data):
+    """Write bytes to a temp file and rename it over path so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def dump_state(state):
+    """Serialise a state dict for the state file."""
+    return orjson.dumps(state, option=orjson.OPT_INDENT_2 if PRETTY_STATE_FILE else 0)
 
 def save_state():
-    """Save current satellite state to file."""
+    """Save current satellite state to file. Returns True on success."""
+    global last_saved_state
     try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(satellite_states, f)
-            logging.info(f"Saved state to file: {satellite_states}")
+        # Snapshot under the writer lock, but never hold it across file I/O
+        with state_lock:
+            snapshot = dump_state(satellite_states)
+        if snapshot == last_saved_state:
+            return True
+        write_file_atomically(STATE_FILE, snapshot)
+        last_saved_state = snapshot
+        logging.info(f"Saved state to file ({len(snapshot)} bytes)")
+        return True
     except Exception as e:
         logging.error(f"Error saving state: {e}")
+        return False
+
+def apply_journal_record(state, record):
+    """Apply a single journal record to a state dict.
+    
+    Satellite entries are never mutated in place: each change publishes a new
+    dict into its slot, so readers always see a consistent entry without locking.
+    """
+    satellites = state['satellite_states']
+    op = record.get('op')
+    
+    if op == 'clear_tx':
+        for sat, satellite in enumerate(satellites):
+            satellites[sat] = {**satellite, 'transmission_times': []}
+        return
+    
+    sat = record.get('sat')
+    if not isinstance(sat, int) or not 0 <= sat < len(satellites):
+        logging.error(f"Ignoring journal record for unknown satellite: {record}")
+        return
+    
+    if op == 'solved':
+        if not isinstance(record['data'], bool):
+            raise TypeError(f"solved must be a bool, not {type(record['data']).__name__}")
+        satellites[sat] = {**satellites[sat], 'solved': record['data']}
+    elif op == 'set_tx':
+        if not isinstance(record['data'], list):
+            raise TypeError(f"transmission_times must be a list, not {type(record['data']).__name__}")
+        satellites[sat] = {**satellites[sat], 'transmission_times': record['data']}
+    else:
+        logging.error(f"Ignoring unknown journal record: {record}")
+
+def replay_journal_line(state, line):
+    """Apply one journal line to a state dict. Returns False if it was skipped."""
+    try:
+        record = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        logging.error(f"Skipping malformed journal line: {line!r}")
+        return False
+    try:
+        apply_journal_record(state, record)
+    except (AttributeError, KeyError, TypeError) as e:
+        # Valid JSON but not a usable record; skip it without abandoning the rest
+        logging.error(f"Skipping invalid journal record {line!r}: {e}")
+        return False
+    return True
+
+def replay_journal(state):
+    """Replay the journal file onto a state dict.
+    
+    An unterminated final line (a crash mid-append) is cut off, or terminated if
+    it parsed, so the next append can't land on the same line and be lost.
+    """
+    try:
+        if not os.path.exists(JOURNAL_FILE):
+            return
+        with open(JOURNAL_FILE, 'rb') as f:
+            data = f.read()
+        lines = data.split(b'\n')
+        tail = lines.pop()  # Empty when the journal ends with a newline
+        for line in lines:
+            if line:
+                replay_journal_line(state, line)
+        if tail:
+            with open(JOURNAL_FILE, 'r+b') as f:
+                if replay_journal_line(state, tail):
+                    f.seek(0, os.SEEK_END)
+                    f.write(b'\n')
+                else:
+                    f.truncate(len(data) - len(tail))
+                    logging.error("Truncated torn final journal line")
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception as e:
+        logging.error(f"Error replaying journal: {e}")
+
+def record_state_change(records):
+    """Apply state change records in memory and queue them for the journal."""
+    global state_version
+    with state_lock:  # Serialise writers; the LED thread reads without locking
+        for record in records:
+            apply_journal_record(satellite_states, record)
+        state_version += 1
+        pending_records.extend(records)
+    warm_transmission_schedules()
+    led_wake.set()
+    state_dirty.set()
+
+def warm_transmission_schedules():
+    """Parse every satellite's windows now so the LED thread only compares datetimes."""
+    for satellite in satellite_states['satellite_states']:
+        if satellite['transmission_times']:
+            try:
+                get_transmission_schedule(satellite['transmission_times'])
+            except Exception as e:
+                logging.error(f"Error building transmission schedule: {e}")
+
+def flush_journal():
+    """Append all queued state change records to the journal."""
+    # Drain and append under one lock so compaction or the shutdown flush can't
+    # run between them and leave drained records stale or unwritten
+    with journal_lock:
+        records = []
+        while pending_records:
+            records.append(pending_records.popleft())
+        if not records:
+            return
+        try:
+            payload = b''.join(orjson.dumps(record) + b'\n' for record in records)
+            with open(JOURNAL_FILE, 'ab') as f:
+                f.write(payload)
+        except Exception:
+            # Requeue so the next flush retries these records first
+            pending_records.extendleft(reversed(records))
+            raise
+
+def compact_state():
+    """Fold the journal into the baseline state file and truncate it."""
+    with journal_lock:
+        flush_journal()
+        if not os.path.exists(JOURNAL_FILE) or os.path.getsize(JOURNAL_FILE) == 0:
+            return
+        if not save_state():
+            return
+        # Truncate only after the baseline is written; replaying again is harmless
+        open(JOURNAL_FILE, 'wb').close()
+        logging.info("Compacted state journal")
+
+def state_persister():
+    """Write queued state changes to disk off the request path."""
+    while running:
+        state_dirty.wait()
+        state_dirty.clear()
+        try:
+            flush_journal()
+        except Exception as e:
+            logging.error(f"Error persisting state: {e}")
+        time.sleep(0.5)  # Coalesce bursts into at most 2 writes per second
+
+def state_compactor():
+    """Periodically compact the state journal."""
+    while running:
+        time.sleep(COMPACT_INTERVAL)
+        try:
+            compact_state()
+        except Exception as e:
+            logging.error(f"Error compacting state: {e}")
 
 # Global state
+journal_lock = threading.RLock()  # Guards journal appends against compaction
+state_lock = threading.Lock()  # Serialises concurrent state writers
+pending_records = deque()  # State changes not yet written to the journal
+state_dirty = threading.Event()  # Set when pending_records needs flushing
+state_version = 0  # Bumped on every in-memory state change
+last_saved_state = None  # Bytes of the last state file write, to skip identical rewrites
 satellite_states = load_state()
+warm_transmission_schedules()
+
+# Frames are lists of packed colour ints, one per LED, pushed to the strip in one write
+shown_frame = None  # Last frame sent to the strip
+strip_lock = threading.Lock()  # Serialises strip buffer writes and show()
+
+def probe_strip_writer():
+    """Pick the fastest working way to copy a frame into the strip buffer."""
+    led_data = getattr(strip, '_led_data', None)
+    
+    def write_slice(frame):
+        # Explicit step: some rpi_ws281x versions build range(start, stop, step) from the slice
+        led_data[0:TOTAL_LED_COUNT:1] = frame
+    
+    def write_items(frame):
+        # Index _led_data directly, skipping setPixelColor's wrapper
+        set_item = led_data.__setitem__  # Bound once per frame, not per pixel
+        for i, colour in enumerate(frame):
+            set_item(i, colour)
+    
+    def write_pixels(frame):
+        set_pixel = strip.setPixelColor  # Bound once per frame, not per pixel
+        for i, colour in enumerate(frame):
+            set_pixel(i, colour)
+    
+    if led_data is not None:
+        for writer in (write_slice, write_items):
+            try:
+                writer([COLOR_OFF] * TOTAL_LED_COUNT)
+                logging.info(f"LED strip writes using {writer.__name__}")
+                return writer
+            except (TypeError, ValueError, IndexError) as e:
+                logging.info(f"LED strip does not support {writer.__name__}: {e}")
+    return write_pixels
+
+# Copies a frame into the strip's pixel buffer
+write_strip = probe_strip_writer()
 
 def set_all_pixels(colour):
     """Set all pixels to the specified colour."""
-    for i in range(strip.numPixels()):
-        strip.setPixelColor(i, colour)
-    strip.show()
-
-def set_pixel_colour(pixel_index, colour):
-    """Set a specific pixel to the specified colour."""
-    if 0 <= pixel_index < strip.numPixels():
-        strip.setPixelColor(pixel_index, colour)
+    show_frame([colour] * TOTAL_LED_COUNT, force=True)
+
+def show_frame(frame, force=False):
+    """Copy a frame into the strip in one bulk write and show it.
+    
+    The DMA transfer is skipped when the frame matches what was last shown.
+    Once shutdown has started only forced frames (the blackout) are shown.
+    """
+    global shown_frame
+    with strip_lock:  # rpi_ws281x is not thread-safe; shutdown paints from another thread
+        if not force and (shutting_down or frame == shown_frame):
+            return
+        write_strip(frame)
         strip.show()
+        shown_frame = frame
 
-def set_satellite_leds(satellite_index, colour):
-    """Set all LEDs for a specific satellite to the given colour."""
-    for led_index in get_satellite_led_indices(satellite_index):
-        set_pixel_colour(led_index, colour)
+def configure_led_thread_scheduling():
+    """Give the calling (LED) thread real-time priority and pin it to a core."""
+    try:
+        if LED_RT_PRIORITY > 0:
+            # On Linux, pid 0 targets the calling thread rather than the whole process
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(LED_RT_PRIORITY))
+            logging.info(f"LED thread running with SCHED_FIFO priority {LED_RT_PRIORITY}")
+    except (AttributeError, OSError) as e:
+        logging.error(f"Could not set LED thread real-time priority: {e}")
+    try:
+        if LED_CPU:
+            os.sched_setaffinity(0, {int(LED_CPU)})
+            logging.info(f"LED thread pinned to CPU {LED_CPU}")
+    except (AttributeError, OSError, ValueError) as e:
+        logging.error(f"Could not pin LED thread to CPU {LED_CPU}: {e}")
+
+def prepare_frame(current_time, elapsed):
+    """Build the next frame.
+    
+    Returns the frame, each satellite's transmitting flag and next transmission change.
+    """
+    # Snapshot satellite entries; the slice copies references without locking
+    satellites = satellite_states['satellite_states'][:SATELLITE_COUNT]
+    
+    # Blink phase: the second half of each second shows blue on transmitting satellites
+    blue_phase = (int(elapsed * 2) & 1) == 1
+    
+    # Decide every satellite's colour with a table lookup, then expand to LEDs
+    statuses = [transmission_status(satellite_state['transmission_times'], current_time)
+                for satellite_state in satellites]
+    transmitting = [satellite_transmitting for satellite_transmitting, _ in statuses]
+    satellite_colours = [
+        SATELLITE_PALETTE[(bool(satellite_state['solved']) << 1) | (blue_phase and satellite_transmitting)]
+        for satellite_state, satellite_transmitting in zip(satellites, transmitting)
+    ]
+    frame = [colour for colour in satellite_colours for _ in range(LEDS_PER_SATELLITE)]
+    frame.extend([COLOR_OFF] * (TOTAL_LED_COUNT - len(frame)))  # Satellites missing from state stay dark
+    return frame, transmitting, [next_change for _, next_change in statuses]
+
+def next_frame_timeout(transmitting, next_changes, current_time, elapsed):
+    """Seconds until the next blink edge or transmission window boundary."""
+    timeout = LED_MAX_WAIT
+    if any(transmitting):
+        timeout = min(timeout, (int(elapsed * 2) + 1) / 2 - elapsed)
+    for change in next_changes:
+        if change is not None:
+            timeout = min(timeout, (change - current_time).total_seconds())
+    return max(timeout, 0.0)
 
 def update_led_state():
     """Update LED states based on satellite transmission times and solved status"""
-    global start_time
+    configure_led_thread_scheduling()
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)  # Captured once at startup
+    frame_count = 0
+    last_frame_log = time.monotonic()
+    last_error = None  # (type, message) of the last logged exception
+    error_backoff = 1.0  # Seconds to wait before retrying after an error
     while running:  # Use the global running flag
         try:
+            # Pipeline: prepare the frame from a state snapshot, start the DMA
+            # transfer, then do the remaining Python work while it is in flight
             current_time = datetime.now()
+            elapsed = time.monotonic() - start_mono
+            frame, transmitting, next_changes = prepare_frame(current_time, elapsed)
             
-            # Load current state
-            with open(STATE_FILE, 'r') as f:
-                state = json.load(f)
-                logging.debug(f"Loaded state: {state}")
+            # Single bulk write and show() per frame, only if something changed
+            show_frame(frame)
+            last_error = None
+            error_backoff = 1.0
             
-            # Update each LED based on its satellite's state
-            for satellite_index, satellite_state in enumerate(state['satellite_states']):
-                # Get LED indices for this satellite
-                led_indices = get_satellite_led_indices(satellite_index)
-                
-                # Check if satellite is currently transmitting
-                transmitting_status = is_transmitting(satellite_state['transmission_times'])
-                
-                # Update each LED for this satellite
-                for led_index in led_indices:
-                    # Update LED based on state
-                    if transmitting_status:
-                        # If transmitting, alternate between state colour and blue
-                        if satellite_state['solved']:
-                            # Solved and transmitting: alternate between green and blue
-                            if (current_time - start_time).total_seconds() % 1.0 < 0.5:
-                                strip.setPixelColor(led_index, Color(0, BRIGHTNESS['solved'], 0))  # Green (GRB)
-                                logging.debug(f"LED {led_index}: Setting green (solved)")
-                            else:
-                                strip.setPixelColor(led_index, Color(0, 0, BRIGHTNESS['transmitting']))  # Blue (GRB)
-                                logging.debug(f"LED {led_index}: Setting blue (transmitting)")
-                        else:
-                            # Not solved and transmitting: alternate between red and blue
-                            if (current_time - start_time).total_seconds() % 1.0 < 0.5:
-                                strip.setPixelColor(led_index, Color(BRIGHTNESS['unsolved'], 0, 0))  # Red (GRB)
-                                logging.debug(f"LED {led_index}: Setting red (unsolved)")
-                            else:
-                                strip.setPixelColor(led_index, Color(0, 0, BRIGHTNESS['transmitting']))  # Blue (GRB)
-                                logging.debug(f"LED {led_index}: Setting blue (transmitting)")
-                    else:
-                        # If not transmitting, show solid state colour
-                        if satellite_state['solved']:
-                            # Solved: solid green
-                            strip.setPixelColor(led_index, Color(0, BRIGHTNESS['solved'], 0))  # Green (GRB)
-                            logging.debug(f"LED {led_index}: Setting solid green (solved)")
-                        else:
-                            # Not solved: solid red
-                            strip.setPixelColor(led_index, Color(BRIGHTNESS['unsolved'], 0, 0))  # Red (GRB)
-                            logging.debug(f"LED {led_index}: Setting solid red (unsolved)")
+            timeout = next_frame_timeout(transmitting, next_changes, current_time, elapsed)
             
-            strip.show()
-            logging.debug("Updated all LEDs")
-            time.sleep(0.1)  # Update every 100ms
+            # Summarise rendering at most once per second instead of per frame
+            if debug_enabled:
+                frame_count += 1
+                now_mono = time.monotonic()
+                if now_mono - last_frame_log >= 1.0:
+                    logging.debug("Rendered %d LED frames", frame_count)
+                    last_frame_log = now_mono
+            
+            # Sleep until the next deadline or until a state change wakes us
+            led_wake.wait(timeout)
+            led_wake.clear()
             
         except Exception as e:
-            print(f"Exception in thread Thread-1 (update_led_state):\n{traceback.format_exc()}")
-            logging.error(f"Error in update_led_state: {e}")
-            time.sleep(1)  # Wait before retrying
+            # Only format and log a traceback when the error changes; back off on repeats
+            error = (type(e).__name__, str(e))
+            if error != last_error:
+                logging.exception("Error in update_led_state: %s", e)
+                last_error = error
+                error_backoff = 1.0
+            else:
+                error_backoff = min(error_backoff * 2, 10.0)
+            time.sleep(error_backoff)  # Wait before retrying
+
+def verify_webhook_secret():
+    """Check the X-Webhook-Secret header in constant time."""
+    secret = request.headers.get('X-Webhook-Secret')
+    if not secret:
+        return False
+    return hmac.compare_digest(secret.encode(), WEBHOOK_SECRET_BYTES)
+
+def parse_json_body():
+    """Decode the request body with orjson, returning None if it is empty or invalid."""
+    try:
+        return orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return None
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Handle webhook events from CTFd"""
     try:
-        # Log incoming request
-        print("\n=== Webhook Request Received ===")
-        print(f"Headers: {dict(request.headers)}")
-        print(f"Raw Data: {request.get_data()}")
-        print(f"WEBHOOK_SECRET from env: {WEBHOOK_SECRET}")
-        
-        # Verify webhook secret
-        secret = request.headers.get('X-Webhook-Secret')
-        print(f"Received secret: {secret}")
-        print(f"Secret match: {secret == WEBHOOK_SECRET}")
-        
-        if not secret or secret != WEBHOOK_SECRET:
-            print(f"Invalid or missing secret. Received: {secret}, Expected: {WEBHOOK_SECRET}")
+        # Verify webhook secret before touching the body
+        if not verify_webhook_secret():
+            logging.warning("Webhook rejected: invalid or missing secret")
             return jsonify({'error': 'Invalid webhook secret'}), 401
         
         # Parse request data
-        data = request.get_json()
-        if not data:
-            print("No JSON data received")
+        data = parse_json_body()
+        if not data or not isinstance(data, dict):
+            logging.warning("Webhook rejected: no JSON data received")
             return jsonify({'error': 'No data provided'}), 400
-            
-        print(f"Parsed data: {data}")
+        logging.debug("Webhook data: %r", data)
         
         # Extract challenge ID and event type
         challenge_id = data.get('challenge_id')
         event_type = data.get('event')
         
         if challenge_id is None or event_type is None:
-            print(f"Missing required fields. challenge_id: {challenge_id}, event: {event_type}")
+            logging.warning("Webhook rejected: missing fields (challenge_id=%r, event=%r)", challenge_id, event_type)
             return jsonify({'error': 'Missing required fields'}), 400
-            
-        print(f"Processing challenge_id: {challenge_id}, event: {event_type}")
         
-        # Load current state
-        with open(STATE_FILE, 'r') as f:
-            state = json.load(f)
-            print(f"Current state: {state}")
+        # type() rather than isinstance() so JSON true/false aren't taken as satellites 1/0
+        if type(challenge_id) is not int or not 0 <= challenge_id < SATELLITE_COUNT:
+            logging.warning("Webhook rejected: invalid challenge_id %r", challenge_id)
+            return jsonify({'error': 'Invalid challenge_id'}), 400
         
-        # Update state based on event
+        # Record state change based on event
         if event_type == 'solve':
-            state['satellite_states'][challenge_id]['solved'] = True
-            print(f"Set satellite {challenge_id} as solved")
+            solved = True
         elif event_type == 'unsolve':
-            state['satellite_states'][challenge_id]['solved'] = False
-            print(f"Set satellite {challenge_id} as unsolved")
+            solved = False
         else:
-            print(f"Unknown event type: {event_type}")
+            logging.warning("Webhook rejected: unknown event type %r", event_type)
             return jsonify({'error': 'Invalid event type'}), 400
         
-        # Save updated state
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=4)
-            
-        print("State updated successfully")
-        print("=== Webhook Request Completed ===\n")
+        # Apply the change and queue it for the journal
+        record_state_change([{'sat': challenge_id, 'op': 'solved', 'data': solved}])
+        logging.info("Set satellite %d as %s", challenge_id, 'solved' if solved else 'unsolved')
         return jsonify({'status': 'success'})
         
     except Exception as e:
-        print(f"\n=== Webhook Error ===")
-        print(f"Error processing webhook: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
-        print("=== Webhook Error End ===\n")
+        logging.error("Error processing webhook: %s", e, exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+# Cached /health response: (state_version, monotonic timestamp, body bytes)
+HEALTH_CACHE_TTL = 1.0  # Seconds
+health_cache = (None, 0.0, b'')
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
-    return jsonify({
-        'status': 'healthy',
-        'satellite_count': SATELLITE_COUNT,
-        'leds_per_satellite': LEDS_PER_SATELLITE,
-        'total_led_count': TOTAL_LED_COUNT,
-        'satellite_states': satellite_states
-    })
+    global health_cache
+    version, timestamp, body = health_cache
+    if version != state_version or time.monotonic() - timestamp >= HEALTH_CACHE_TTL:
+        version = state_version  # Read before serialising so a concurrent change invalidates
+        body = orjson.dumps({
+            'status': 'healthy',
+            'satellite_count': SATELLITE_COUNT,
+            'leds_per_satellite': LEDS_PER_SATELLITE,
+            'total_led_count': TOTAL_LED_COUNT,
+            'satellite_states': satellite_states
+        })
+        health_cache = (version, time.monotonic(), body)
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/update_transmission_times', methods=['POST'])
 def update_transmission_times():
     """Update transmission times for satellites"""
     try:
         # Verify webhook secret
-        secret = request.headers.get('X-Webhook-Secret')
-        if not secret or secret != WEBHOOK_SECRET:
+        if not verify_webhook_secret():
             return jsonify({'error': 'Invalid webhook secret'}), 401
         
         # Parse request data
-        data = request.get_json()
-        if not data:
+        data = parse_json_body()
+        if not data or not isinstance(data, dict):
             return jsonify({'error': 'No data provided'}), 400
             
-        # Load current state
-        with open(STATE_FILE, 'r') as f:
-            state = json.load(f)
-        
-        # Update transmission times
+        # Build transmission time updates, keeping only merged upcoming windows
+        current_time = datetime.now()
+        records = []
         for satellite_id, transmission_times in data.items():
-            if 0 <= int(satellite_id) < SATELLITE_COUNT:
-                state['satellite_states'][int(satellite_id)]['transmission_times'] = transmission_times
+            if not (satellite_id.isascii() and satellite_id.isdigit()) or int(satellite_id) >= SATELLITE_COUNT:
+                return jsonify({'error': f'Invalid satellite id {satellite_id!r}'}), 400
+            if not isinstance(transmission_times, list):
+                return jsonify({'error': f'Invalid transmission times for satellite {satellite_id}'}), 400
+            for window in transmission_times:
+                try:
+                    parse_transmission_window(*window)
+                except (TypeError, ValueError):
+                    return jsonify({'error': f'Invalid transmission window for satellite {satellite_id}: {window!r}'}), 400
+            records.append({
+                'sat': int(satellite_id),
+                'op': 'set_tx',
+                'data': normalize_transmission_times(transmission_times, current_time)
+            })
         
-        # Save updated state
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=4)
+        # Apply the changes and queue them for the journal
+        record_state_change(records)
             
         return jsonify({'status': 'success'})
         
@@ -379,21 +778,11 @@ def clear_transmission_times():
     """Clear all transmission times for satellites"""
     try:
         # Verify webhook secret
-        secret = request.headers.get('X-Webhook-Secret')
-        if not secret or secret != WEBHOOK_SECRET:
+        if not verify_webhook_secret():
             return jsonify({'error': 'Invalid webhook secret'}), 401
             
-        # Load current state
-        with open(STATE_FILE, 'r') as f:
-            state = json.load(f)
-        
         # Clear transmission times for all satellites
-        for satellite in state['satellite_states']:
-            satellite['transmission_times'] = []
-        
-        # Save updated state
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=4)
+        record_state_change([{'sat': None, 'op': 'clear_tx', 'data': None}])
             
         return jsonify({'status': 'success', 'message': 'All transmission times cleared'})
         
@@ -405,14 +794,13 @@ def clear_transmission_times():
 def get_transmitting_satellites():
     """Get list of currently transmitting satellites"""
     try:
-        # Load current state
-        with open(STATE_FILE, 'r') as f:
-            state = json.load(f)
+        state = satellite_states
         
         # Check each satellite
+        current_time = datetime.now()
         transmitting_satellites = []
         for i, satellite in enumerate(state['satellite_states']):
-            if is_transmitting(satellite['transmission_times']):
+            if is_transmitting(satellite['transmission_times'], current_time):
                 transmitting_satellites.append({
                     'satellite_id': i,
                     'solved': satellite['solved'],
@@ -428,45 +816,16 @@ def get_transmitting_satellites():
         logging.error(f"Error getting transmitting satellites: {e}")
         return jsonify({'error': str(e)}), 500
 
-def initialize_state_file():
-    """Create or initialize the state file with default values"""
-    try:
-        # Check if file exists and is not empty
-        if os.path.exists(STATE_FILE) and os.path.getsize(STATE_FILE) > 0:
-            return
-            
-        # Create default state structure
-        default_state = {
-            "satellite_states": []
-        }
-        
-        # Add states for each satellite
-        for i in range(SATELLITE_COUNT):
-            default_state["satellite_states"].append({
-                "satellite_id": i,
-                "solved": False,
-                "transmission_times": []
-            })
-        
-        # Save to file
-        with open(STATE_FILE, 'w') as f:
-            json.dump(default_state, f, indent=4)
-            
-        logging.info(f"Initialized state file with {SATELLITE_COUNT} satellites")
-        
-    except Exception as e:
-        logging.error(f"Error initializing state file: {e}")
-        raise
-
 if __name__ == '__main__':
     try:
-        # Initialize state file if needed
-        initialize_state_file()
-        
         # Start the LED control thread
         led_thread = threading.Thread(target=update_led_state, daemon=True)
         led_thread.start()
         
+        # Start the state persistence threads
+        threading.Thread(target=state_persister, daemon=True).start()
+        threading.Thread(target=state_compactor, daemon=True).start()
+        
         # Get port from environment variable or use default
         port = int(os.getenv('PORT', 5000))
         
@@ -474,9 +833,9 @@ if __name__ == '__main__':
         logging.info(f"Server starting on port {port}")
         
         # Create and start the server
-        from werkzeug.serving import make_server
-        server = make_server('0.0.0.0', port, app)
-        server.serve_forever()
+        from waitress import create_server
+        server = create_server(app, host='0.0.0.0', port=port, threads=SERVER_THREADS)
+        server.run()
     except KeyboardInterrupt:
         print("\nShutting down gracefully...")
         shutdown_server()
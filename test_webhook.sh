@@ -1,9 +1,9 @@
 #!/bin/bash
 
-# Configuration
-HOST="localhost"
-PORT="5000"
-SECRET="super_secret"  # Change this to match your secret.env
+# Configuration (override via environment, e.g. HOST=192.168.104.110 ./test_webhook.sh)
+HOST="${HOST:-localhost}"
+PORT="${PORT:-5000}"
+SECRET="${SECRET:-super_secret}"  # Change this to match your secret.env
 
 # Colors for output
 GREEN='\033[0;32m'